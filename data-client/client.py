@@ -1,29 +1,141 @@
-import requests
-import time
+import asyncio
+import httpx
 from pathlib import Path
+import queue
 import zipfile
-import io
+import tempfile
 
 API_URL = "http://dataops-api:8000/generate/Zr49Cu49Al2/21/0"
 
 output_dir = Path("/app/output")
 output_dir.mkdir(parents=True, exist_ok=True)
 
-for attempt in range(10):
+CHUNK_SIZE = 1024 * 1024  # 1 MiB
+
+# NOTE: pool of reusable buffers for file copies
+COPY_BUFFER_POOL = queue.SimpleQueue()
+
+# NOTE: bytes received before a failed attempt are kept here, and the next attempt
+#  only asks the API for the missing ones with a Range request
+PART_FILE = Path(tempfile.gettempdir()) / "dataops_download.zip.part"
+
+# NOTE: ETag of the archive the part file belongs to, sent back in If-Range so that
+#  the API sends the whole archive again (200) if it has changed in between
+PART_ETAG_FILE = PART_FILE.with_name(PART_FILE.name + ".etag")
+
+# NOTE: a single pooled client is shared by every attempt (and any future call),
+#  so keep-alive connections are reused instead of re-opened on each retry
+client = httpx.AsyncClient(
+    limits=httpx.Limits(max_connections=100, max_keepalive_connections=20),
+    http2=True,
+    timeout=30.0,
+)
+
+
+def copy_file_object(src, dst):
+    """Copies a binary file object into another through a pooled buffer."""
+
+    try:
+        buffer = COPY_BUFFER_POOL.get_nowait()
+    except queue.Empty:
+        buffer = bytearray(CHUNK_SIZE)
+
     try:
-        print(f"[Attempt {attempt + 1}] Connecting to {API_URL} ...")
-        response = requests.get(API_URL)
-
-        if response.status_code == 200:
-            z = zipfile.ZipFile(io.BytesIO(response.content))
-            z.extractall(output_dir)
-            print(f"[SUCCESS] Files extracted to {output_dir.resolve()}")
-            break
+        with memoryview(buffer) as view:
+            while size := src.readinto(buffer):
+                dst.write(view[:size])
+    finally:
+        COPY_BUFFER_POOL.put(buffer)
+
+
+def extract_member(z: zipfile.ZipFile, member: zipfile.ZipInfo):
+    """Extracts an archive member through the pooled copy buffers."""
+
+    if "/" in member.filename:
+        z.extract(member, output_dir)
+        return
+
+    with z.open(member) as src, open(output_dir / member.filename, "wb") as dst:
+        copy_file_object(src, dst)
+
+
+def extract_all(z: zipfile.ZipFile):
+    """Extracts the archive members into the output directory."""
+
+    # NOTE: members are extracted one at a time; a ZipFile shares a single file
+    #  handle (and its reference count) between its open members, so it must not
+    #  be read from several threads at once
+    for member in z.infolist():
+        extract_member(z, member)
+
+
+async def fetch():
+    try:
+        for attempt in range(10):
+            try:
+                print(f"[Attempt {attempt + 1}] Connecting to {API_URL} ...")
+
+                offset = PART_FILE.stat().st_size if PART_FILE.exists() else 0
+                etag = (
+                    PART_ETAG_FILE.read_text().strip()
+                    if PART_ETAG_FILE.exists()
+                    else None
+                )
+
+                # NOTE: a part file without an ETag cannot be safely resumed
+                if offset and etag:
+                    headers = {"Range": f"bytes={offset}-", "If-Range": etag}
+                else:
+                    headers = {}
+
+                async with client.stream("GET", API_URL, headers=headers) as response:
+
+                    if response.status_code in (200, 206):
+                        # NOTE: the archive is streamed to a file instead of being
+                        #  buffered in memory; ZipFile then seeks the central
+                        #  directory straight from disk
+                        mode = "ab" if response.status_code == 206 else "wb"
+
+                        if response.status_code == 200:
+                            if "etag" in response.headers:
+                                PART_ETAG_FILE.write_text(response.headers["etag"])
+                            else:
+                                PART_ETAG_FILE.unlink(missing_ok=True)
+
+                        with open(PART_FILE, mode) as part:
+                            async for chunk in response.aiter_bytes(CHUNK_SIZE):
+                                part.write(chunk)
+
+                        with zipfile.ZipFile(PART_FILE) as z:
+                            extract_all(z)
+
+                        PART_FILE.unlink()
+                        PART_ETAG_FILE.unlink(missing_ok=True)
+
+                        print(f"[SUCCESS] Files extracted to {output_dir.resolve()}")
+                        break
+                    elif response.status_code == 416:
+                        print("[ERROR] Partial download is stale; restarting it")
+                        PART_FILE.unlink()
+                        PART_ETAG_FILE.unlink(missing_ok=True)
+                    else:
+                        print(
+                            f"[ERROR] API responded with status {response.status_code}"
+                        )
+
+                await asyncio.sleep(3)
+            except zipfile.BadZipFile as e:
+                print(f"[ERROR] Corrupted archive: {e}")
+                PART_FILE.unlink()
+                PART_ETAG_FILE.unlink(missing_ok=True)
+                await asyncio.sleep(3)
+            except httpx.TransportError as e:
+                print(f"[ERROR] Connection failed: {e}")
+                await asyncio.sleep(3)
         else:
-            print(f"[ERROR] API responded with status {response.status_code}")
-            time.sleep(3)
-    except requests.exceptions.ConnectionError as e:
-        print(f"[ERROR] Connection failed: {e}")
-        time.sleep(3)
-else:
-    print("[FAILED] Could not connect to API after multiple attempts.")
+            print("[FAILED] Could not connect to API after multiple attempts.")
+    finally:
+        await client.aclose()
+
+
+asyncio.run(fetch())
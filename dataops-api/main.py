@@ -1,10 +1,22 @@
-from fastapi import FastAPI, Path, HTTPException, status, Body
-from fastapi.responses import FileResponse
+from fastapi import FastAPI, Path, HTTPException, Request, BackgroundTasks, status, Body
+from fastapi.responses import FileResponse, Response, StreamingResponse
 from pydantic import BaseModel, Field
 from pathlib import Path as FilePath
 from datetime import datetime, timezone
-import shutil
-import json
+from contextlib import asynccontextmanager, closing, contextmanager
+from functools import lru_cache
+import anyio
+import asyncio
+import hashlib
+import io
+import os
+import queue
+import sqlite3
+import threading
+import time
+import zipfile
+import uuid
+import orjson
 
 ##########################################################################
 #
@@ -12,24 +24,186 @@ import json
 #
 ##########################################################################
 
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+
+    yield
+
+    # NOTE: on shutdown, the WAL is checkpointed (and fsynced) into the DB file
+    with closing(sqlite3.connect(DB_AVAILABLE_RUNS_FILE)) as conn:
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+
 app = FastAPI(
     title="DataOps API (P3)",
     description="Prototype API to package and serve raw data files based on (NC, ID_RUN, SUB_RUN) "
     "selection. It mimics calls to an HPC in the cloud service.",
     version="0.1.0",
+    lifespan=lifespan,
 )
 
 DATA_ROOT = FilePath("/data/ML/big-data-full")
+DATA_ROOT_STR = str(DATA_ROOT)  # NOTE: for joining paths as strings on hot paths
+
+DB_AVAILABLE_RUNS_FILE = FilePath("/tmp/available_runs.db")
+DB_AVAILABLE_RUNS_LEGACY_FILE = FilePath("/tmp/available_runs.json")
+
+# NOTE: one row per (NC, ID_RUN) in a SQLite DB in WAL mode, so that each mutation
+#  is a single-row write and several uvicorn workers can share the same DB; the
+#  setup connection is in autocommit mode like the request ones, as closing it
+#  would otherwise roll back the implicit transaction opened by the first INSERT
+with closing(sqlite3.connect(DB_AVAILABLE_RUNS_FILE, isolation_level=None)) as conn:
+    conn.execute("PRAGMA journal_mode=WAL")
+
+    # NOTE: the schema setup below runs as a single write transaction, so workers
+    #  starting together apply it one at a time (the later ones find it done) and a
+    #  crash midway leaves the DB as it was
+    conn.execute("BEGIN IMMEDIATE")
+
+    # NOTE: the schedule times are stored both as ISO strings (for display) and as
+    #  epoch seconds (for status checks)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS runs (
+            nc TEXT NOT NULL,
+            id_run TEXT NOT NULL,
+            run_scheduled_at TEXT NOT NULL,
+            sub_runs_scheduled_at TEXT,
+            run_scheduled_epoch REAL NOT NULL,
+            sub_runs_scheduled_epoch REAL,
+            PRIMARY KEY (nc, id_run)
+        )
+        """)
+
+    # NOTE: the SUB_RUNs of a run are a set of rows keyed by (NC, ID_RUN, SUB_RUN),
+    #  so checking one is an index lookup and adding some never rewrites the others
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS sub_runs (
+            nc TEXT NOT NULL,
+            id_run TEXT NOT NULL,
+            sub_run TEXT NOT NULL,
+            PRIMARY KEY (nc, id_run, sub_run)
+        ) WITHOUT ROWID
+        """)
+
+    # NOTE: runs recorded in the JSON file used before the DB are imported into an
+    #  empty DB (the file itself is left untouched)
+    if (
+        DB_AVAILABLE_RUNS_LEGACY_FILE.exists()
+        and conn.execute("SELECT 1 FROM runs LIMIT 1").fetchone() == None
+    ):
+        for nc, run_entries in orjson.loads(
+            DB_AVAILABLE_RUNS_LEGACY_FILE.read_bytes()
+        ).items():
+            for run_entry in run_entries:
+                run_scheduled_at = run_entry["run_scheduled_at"]
+                sub_runs_scheduled_at = run_entry.get("sub_runs_scheduled_at")
+
+                conn.execute(
+                    "INSERT INTO runs VALUES (?, ?, ?, ?, ?, ?)",
+                    (
+                        nc,
+                        run_entry["id_run"],
+                        run_scheduled_at,
+                        sub_runs_scheduled_at,
+                        datetime.fromisoformat(
+                            run_scheduled_at.replace("Z", "+00:00")
+                        ).timestamp(),
+                        (
+                            datetime.fromisoformat(
+                                sub_runs_scheduled_at.replace("Z", "+00:00")
+                            ).timestamp()
+                            if sub_runs_scheduled_at != None
+                            else None
+                        ),
+                    ),
+                )
+                conn.executemany(
+                    "INSERT OR IGNORE INTO sub_runs VALUES (?, ?, ?)",
+                    [
+                        (nc, run_entry["id_run"], sub_run)
+                        for sub_run in run_entry["sub_runs"]
+                    ],
+                )
+
+    # NOTE: next ID_RUN to be allocated per NC, so scheduling doesn't have to scan
+    #  the existing runs; seeded from the runs imported above, if any
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS next_id_runs (
+            nc TEXT PRIMARY KEY,
+            next_id_run INTEGER NOT NULL
+        )
+        """)
+    conn.execute("""
+        INSERT OR IGNORE INTO next_id_runs (nc, next_id_run)
+        SELECT nc, MAX(CAST(id_run AS INTEGER)) + 1 FROM runs GROUP BY nc
+        """)
+
+    # NOTE: bumped by every write transaction, so that a cached rendering of the
+    #  runs can tell whether it is stale (in any worker sharing the DB)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS runs_version (version INTEGER NOT NULL)
+        """)
+    conn.execute("""
+        INSERT INTO runs_version (version)
+        SELECT 0 WHERE NOT EXISTS (SELECT 1 FROM runs_version)
+        """)
+    conn.execute("COMMIT")
+
+DB_THREAD_LOCAL = threading.local()
+
+# NOTE: rows of the runs table with their SUB_RUNs gathered into a JSON list
+DB_RUNS_SELECT = """
+    SELECT runs.*, (
+        SELECT json_group_array(sub_run) FROM (
+            SELECT sub_run FROM sub_runs
+            WHERE sub_runs.nc = runs.nc AND sub_runs.id_run = runs.id_run
+            ORDER BY CAST(sub_run AS INTEGER)
+        )
+    ) AS sub_runs
+    FROM runs
+    """
 
-DB_AVAILABLE_RUNS_FILE = FilePath("/tmp/available_runs.json")
-
-if DB_AVAILABLE_RUNS_FILE.exists():
-    AVAILABLE_RUNS = json.loads(DB_AVAILABLE_RUNS_FILE.read_text())
-else:
-    AVAILABLE_RUNS = {}
+# NOTE: (runs_version, JSON bytes) of the last rendering of the available runs;
+#  /available answers from it until a write bumps runs_version
+AVAILABLE_RUNS_JSON = None
 
 JOB_RUN_TIME = 300.0  # five minutes in seconds
 
+# NOTE: archives of sub-runs up to this size are streamed to the client while they
+#  are being built; larger ones are built into the archive cache and sent from
+#  there with zero-copy (ASGI pathsend)
+ARCHIVE_STREAM_MAX_SIZE = 64 * 1024 * 1024  # 64 MiB
+
+ARCHIVE_CHUNK_SIZE = 1024 * 1024  # 1 MiB
+
+# NOTE: chunks an archive being streamed can get ahead of the client by
+ARCHIVE_STREAM_MAX_CHUNKS = 8
+
+# NOTE: pool of reusable buffers for file copies, shared by all worker threads
+COPY_BUFFER_POOL = queue.SimpleQueue()
+
+WARM_READ_SIZE = 4096  # first block of each file read when warming FS caches
+
+LIST_DIRECTORY_MIN_AGE = 2.0  # seconds unchanged before a listing is cached
+
+# NOTE: SOAP vectors and DFT outputs compress poorly while DEFLATE would dominate
+#  the time to build an archive, so every member is stored as is
+ARCHIVE_COMPRESSION = zipfile.ZIP_STORED
+
+# NOTE: archives written to disk are kept and reused while their source files
+#  are unchanged; least recently served ones are evicted beyond this size
+ARCHIVE_CACHE_DIR = FilePath("/var/cache/dataops")
+ARCHIVE_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+ARCHIVE_CACHE_MAX_SIZE = 10 * 1024 * 1024 * 1024  # 10 GiB
+ARCHIVE_CACHE_TMP_MAX_AGE = 3600.0  # one hour in seconds
+
+# NOTE: behind nginx, cached archives can be sent by nginx itself (X-Accel-Redirect)
+#  instead of by the API; set to an internal nginx location aliasing the cache
+#  dir, e.g. "/_archives/" for "location /_archives/ { internal; alias
+#  /var/cache/dataops/; }", or leave unset to send them from the API
+ARCHIVE_ACCEL_REDIRECT_LOCATION = os.environ.get("ARCHIVE_ACCEL_REDIRECT_LOCATION")
+
 #
 # General descriptions and examples for Swagger documentation
 #
@@ -74,10 +248,491 @@ STATUS_SCF_NOT_CONVERGED_AND_NO_ICOHP = "SCF_NOT_CONVERGED_AND_NO_ICOHP"
 #
 ##########################################################################
 
+
+def get_db() -> sqlite3.Connection:
+    """Returns the DB connection of the calling thread, opening it on first use."""
+
+    conn = getattr(DB_THREAD_LOCAL, "conn", None)
+
+    if conn == None:
+        # NOTE: autocommit mode; multi-statement writes use db_transaction()
+        conn = sqlite3.connect(DB_AVAILABLE_RUNS_FILE, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+
+        # NOTE: in WAL mode, commits are only appended to the WAL and the fsyncs
+        #  happen at checkpoints, coalescing bursts of writes off the request path;
+        #  a power loss may drop the last commits, but never corrupts the DB
+        conn.execute("PRAGMA synchronous=NORMAL")
+
+        # NOTE: temporary b-trees (e.g., for sorting the runs by numeric ID_RUN)
+        #  are kept in memory instead of in temp files
+        conn.execute("PRAGMA temp_store=MEMORY")
+        DB_THREAD_LOCAL.conn = conn
+
+    return conn
+
+
+@contextmanager
+def db_transaction():
+    """Runs the enclosed statements in a write transaction, rolled back on error."""
+
+    conn = get_db()
+
+    # NOTE: IMMEDIATE takes the write lock upfront, so concurrent read-modify-write
+    #  sequences (e.g., allocating the next ID_RUN) are serialized
+    conn.execute("BEGIN IMMEDIATE")
+
+    try:
+        yield conn
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+
+    conn.execute("UPDATE runs_version SET version = version + 1")
+    conn.execute("COMMIT")
+
+
+def run_entry_from_row(row: sqlite3.Row) -> dict:
+    """Converts a row of the runs table into a run entry."""
+
+    run_entry = {
+        "id_run": row["id_run"],
+        "sub_runs": orjson.loads(row["sub_runs"]),
+        "run_scheduled_at": row["run_scheduled_at"],
+    }
+
+    if row["sub_runs_scheduled_at"] != None:
+        run_entry["sub_runs_scheduled_at"] = row["sub_runs_scheduled_at"]
+
+    return run_entry
+
+
+def get_run_row(conn: sqlite3.Connection, nc: str, id_run: str):
+    """Returns the row for the given NC and ID_RUN, or None if not available."""
+
+    return conn.execute(
+        f"{DB_RUNS_SELECT} WHERE nc = ? AND id_run = ?", (nc, id_run)
+    ).fetchone()
+
+
+def has_sub_run(conn: sqlite3.Connection, nc: str, id_run: str, sub_run: str):
+    """Returns whether the given SUB_RUN is available for the given NC and ID_RUN."""
+
+    return (
+        conn.execute(
+            "SELECT 1 FROM sub_runs WHERE nc = ? AND id_run = ? AND sub_run = ?",
+            (nc, id_run, sub_run),
+        ).fetchone()
+        != None
+    )
+
+
+def available_runs_as_lists() -> dict:
+    """Returns the available runs in the NC -> list of runs layout."""
+
+    available_runs = {}
+
+    for row in get_db().execute(
+        f"{DB_RUNS_SELECT} ORDER BY nc, CAST(id_run AS INTEGER)"
+    ):
+        available_runs.setdefault(row["nc"], []).append(run_entry_from_row(row))
+
+    return available_runs
+
+
+def available_runs_json() -> bytes:
+    """Returns the available runs rendered as JSON, re-rendering them on changes."""
+
+    global AVAILABLE_RUNS_JSON
+
+    # NOTE: the version is read before the runs, so a write in between can only
+    #  make the cached rendering look older than it is (never newer)
+    version = get_db().execute("SELECT version FROM runs_version").fetchone()[0]
+    cached = AVAILABLE_RUNS_JSON
+
+    if cached == None or cached[0] != version:
+        cached = (version, orjson.dumps(available_runs_as_lists()))
+        AVAILABLE_RUNS_JSON = cached
+
+    return cached[1]
+
+
+def warm_directory(directory):
+    """Stats every file under the given directory and reads its first block.
+
+    This warms the dentry/inode and page caches (mostly relevant on network file
+    systems) so that a later download of the same files finds their metadata hot.
+    """
+
+    try:
+        it = os.scandir(directory)
+    except OSError:
+        return
+
+    # NOTE: an unreadable or vanished entry is skipped, without stopping the warming
+    #  of the entries (or sub-runs) after it
+    with it:
+        for entry in it:
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    warm_directory(entry.path)
+                elif entry.is_file():
+                    with open(entry.path, "rb") as f:
+                        os.fstat(f.fileno())
+                        f.read(WARM_READ_SIZE)
+            except OSError:
+                pass
+
+
+def copy_file_object(src, dst):
+    """Copies a binary file object into another through a pooled buffer."""
+
+    try:
+        buffer = COPY_BUFFER_POOL.get_nowait()
+    except queue.Empty:
+        buffer = bytearray(ARCHIVE_CHUNK_SIZE)
+
+    try:
+        with memoryview(buffer) as view:
+            while size := src.readinto(buffer):
+                dst.write(view[:size])
+    finally:
+        COPY_BUFFER_POOL.put(buffer)
+
+
+def prefetch_files(files: list[str]):
+    """Asks the kernel to start reading the given files in the background."""
+
+    if not hasattr(os, "posix_fadvise"):
+        return
+
+    for item in files:
+        try:
+            fd = os.open(item, os.O_RDONLY)
+
+            try:
+                os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+            finally:
+                os.close(fd)
+        except OSError:
+            pass
+
+
+def scan_directory(directory: str) -> tuple[str, ...]:
+    """Returns the names of the files in a directory."""
+
+    # NOTE: scandir reports the type of each entry from the directory read itself,
+    #  so subdirectories are skipped without a stat per entry
+    with os.scandir(directory) as it:
+        return tuple(entry.name for entry in it if entry.is_file())
+
+
+@lru_cache(maxsize=1024)
+def list_directory(directory: str, mtime_ns: int) -> tuple[str, ...]:
+    """Returns the names of the files in a directory, reusing them while unchanged.
+
+    The mtime of the directory is part of the cache key, so adding, removing or
+    renaming entries (which all bump it) yields a new listing.
+    """
+
+    return scan_directory(directory)
+
+
+def collect_sub_run_files(nc: str, id_run: str, sub_run: str):
+    """Returns the files to be archived for a SUB_RUN, and their stats.
+
+    The first stat is that of the sub-run directory itself. Raises a 404 when the
+    SUB_RUN is not available.
+    """
+
+    # Check if the requested SUB_RUN is available (TODO: replicated R1)
+    conn = get_db()
+
+    if not has_sub_run(conn, nc, id_run, sub_run):
+        if get_run_row(conn, nc, id_run) == None:
+            raise HTTPException(
+                status_code=404, detail=f"NC '{nc}' or ID_RUN '{id_run}' not available"
+            )
+
+        raise HTTPException(
+            status_code=404,
+            detail=f"SUB_RUN '{sub_run}' is not available for NC '{nc}', ID_RUN '{id_run}'",
+        )
+
+    # Collecting files
+    # NOTE: paths are joined as plain strings, with no Path objects built per
+    #  request; os.stat, os.scandir, open and zipfile all take them as they are
+    target_dir = os.path.join(
+        DATA_ROOT_STR, nc, "c/md/lammps/100", id_run, "2000", sub_run
+    )
+    soaps_file = os.path.join(
+        DATA_ROOT_STR,
+        f"{nc}-SOAPS",
+        "c/md/lammps/100",
+        id_run,
+        "2000",
+        sub_run,
+        "SOAPS.vec",
+    )
+
+    try:
+        target_dir_stat = os.stat(target_dir)
+    except (FileNotFoundError, NotADirectoryError):
+        raise HTTPException(status_code=404, detail="Target sub-run not found")
+
+    # NOTE: a directory changed again within the mtime granularity of its FS keeps
+    #  the same mtime, so the listing of a recently changed one is not cached (the
+    #  racily clean rule of git); otherwise a stale listing would be served, and
+    #  end up in the archive cache key, until the directory changed once more
+    if time.time() - target_dir_stat.st_mtime < LIST_DIRECTORY_MIN_AGE:
+        names = scan_directory(target_dir)
+    else:
+        names = list_directory(target_dir, target_dir_stat.st_mtime_ns)
+
+    files = [os.path.join(target_dir, name) for name in names]
+
+    # NOTE: files are zipped straight from their source paths, so two of them can
+    #  have the same arcname; as when they were staged into a single directory, the
+    #  SOAPs file replaces a file with the same name in the sub-run directory
+    try:
+        soaps_file_stat = os.stat(soaps_file)
+    except (FileNotFoundError, NotADirectoryError):
+        soaps_file_stat = None
+
+    if soaps_file_stat != None:
+        files = [item for item in files if os.path.basename(item) != "SOAPS.vec"]
+
+    files_stats = [target_dir_stat, *(os.stat(item) for item in files)]
+
+    if soaps_file_stat != None:
+        files.append(soaps_file)
+        files_stats.append(soaps_file_stat)
+
+    return files, files_stats
+
+
+def build_archive(archive, files: list[str]):
+    """Writes the given files into a ZIP archive straight from their source paths.
+
+    The archive can be either a path or a writable binary file object.
+    """
+
+    # NOTE: readahead is requested for every file upfront, so the reads of the
+    #  sub-run directory and of the SOAPs file (in a different tree, possibly on a
+    #  different mount) proceed concurrently while the members are written in turn
+    prefetch_files(files)
+
+    # NOTE: each file is read and written in a single pass; there is no
+    #  intermediate copy into a staging directory
+    with zipfile.ZipFile(archive, "w", ARCHIVE_COMPRESSION, allowZip64=True) as z:
+        for item in files:
+            zinfo = zipfile.ZipInfo.from_file(item, arcname=os.path.basename(item))
+            zinfo.compress_type = ARCHIVE_COMPRESSION
+
+            # NOTE: same as ZipFile.write(), but copying through a pooled 1 MiB
+            #  buffer instead of allocating 8 KiB chunks for every read
+            with open(item, "rb") as src, z.open(zinfo, "w") as dst:
+                copy_file_object(src, dst)
+
+    return archive
+
+
+def get_cached_archive(cache_key: str, files: list[str]):
+    """Returns the cached archive for the given key, building it on a cache miss.
+
+    Returns the archive path and whether it was already cached.
+    """
+
+    archive_path = ARCHIVE_CACHE_DIR / f"{cache_key}.zip"
+
+    # NOTE: refreshing the atime marks the archive as recently used for eviction;
+    #  the mtime is left alone, as Last-Modified (checked by If-Range) comes from it
+    try:
+        st = os.stat(archive_path)
+        os.utime(archive_path, ns=(time.time_ns(), st.st_mtime_ns))
+
+        return archive_path, True
+    except FileNotFoundError:
+        pass
+
+    # NOTE: the archive is built under a unique name and atomically renamed, so a
+    #  concurrent request never serves a partially written archive
+    tmp_path = archive_path.with_suffix(f".{uuid.uuid4().hex}.tmp")
+
+    try:
+        build_archive(tmp_path, files)
+        os.replace(tmp_path, archive_path)
+    finally:
+        tmp_path.unlink(missing_ok=True)
+
+    return archive_path, False
+
+
+def evict_archive_cache():
+    """Removes the least recently used archives while the cache exceeds its size.
+
+    Archives left half-built by an interrupted request are removed as well.
+    """
+
+    entries = []
+    now = time.time()
+
+    with os.scandir(ARCHIVE_CACHE_DIR) as it:
+        for entry in it:
+            # NOTE: entries can vanish after the directory read (a temp archive
+            #  renamed into place, an archive removed by another eviction)
+            try:
+                st = entry.stat()
+            except FileNotFoundError:
+                continue
+
+            if entry.name.endswith(".zip"):
+                entries.append((st.st_atime, st.st_size, entry.path))
+            elif now - st.st_mtime > ARCHIVE_CACHE_TMP_MAX_AGE:
+                FilePath(entry.path).unlink(missing_ok=True)
+
+    cache_size = sum(size for _, size, _ in entries)
+
+    for _, size, path in sorted(entries):
+
+        if cache_size <= ARCHIVE_CACHE_MAX_SIZE:
+            break
+
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+        cache_size -= size
+
+
+class ArchiveWriter(io.RawIOBase):
+    """Unseekable sink for ZipFile that hands the archive bytes over in chunks.
+
+    ZipFile writes to an unseekable sink in its streaming layout (member sizes go
+    in data descriptors after the data), which is identical whether the chunks are
+    sent to the client as they come or collected into a file.
+    """
+
+    def __init__(self, on_chunk):
+        self.on_chunk = on_chunk
+        self.buffer = bytearray()
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self.buffer += b
+
+        if len(self.buffer) >= ARCHIVE_CHUNK_SIZE:
+            self.flush()
+
+        return len(b)
+
+    def flush(self):
+        if self.buffer and not self.closed:
+            self.on_chunk(bytes(self.buffer))
+            self.buffer.clear()
+
+    def close(self):
+        self.buffer.clear()
+        super().close()
+
+
+async def stream_archive(files: list[str]):
+    """Yields the chunks of a ZIP archive with the given files while it is built."""
+
+    send_stream, receive_stream = anyio.create_memory_object_stream(
+        ARCHIVE_STREAM_MAX_CHUNKS
+    )
+
+    # NOTE: the archive is built on a worker thread, blocking on each chunk while
+    #  the client is ARCHIVE_STREAM_MAX_CHUNKS chunks behind
+    def produce():
+        try:
+            build_archive(
+                ArchiveWriter(
+                    lambda chunk: anyio.from_thread.run(send_stream.send, chunk)
+                ),
+                files,
+            )
+        finally:
+            anyio.from_thread.run_sync(send_stream.close)
+
+    producer = asyncio.create_task(anyio.to_thread.run_sync(produce))
+
+    try:
+        async for chunk in receive_stream:
+            yield chunk
+    finally:
+        # NOTE: if the client went away, closing the receiving end makes the
+        #  producer fail on its next chunk and stop building the archive
+        receive_stream.close()
+
+        try:
+            await producer
+        except anyio.BrokenResourceError:
+            pass
+
+
+def parse_range_header(range_header: str, size: int):
+    """Parses a single-range "bytes=start-end" header against the archive size.
+
+    Returns the inclusive (start, end) positions, None when the header is invalid
+    or asks for several ranges (the whole archive is served then), or raises
+    ValueError when the range is not satisfiable.
+    """
+
+    unit, _, byte_range = range_header.partition("=")
+    first, sep, last = byte_range.strip().partition("-")
+
+    if unit.strip() != "bytes" or not sep or "," in byte_range:
+        return None
+
+    try:
+        first = int(first) if first else None
+        last = int(last) if last else None
+    except ValueError:
+        return None
+
+    # NOTE: a range without positions, or ending before it starts, is invalid and
+    #  thus ignored (RFC 9110); only valid ranges past the end get a 416
+    if (first == None and last == None) or (
+        first != None and last != None and last < first
+    ):
+        return None
+
+    if first == None:
+        start, end = max(size - last, 0) if last else size, size - 1
+    else:
+        start, end = first, size - 1 if last == None else min(last, size - 1)
+
+    if start >= size:
+        raise ValueError(f"Range '{range_header}' not satisfiable")
+
+    return start, end
+
+
+def iter_archive(archive, length: int):
+    """Yields length bytes of an already built archive in chunks and closes it."""
+
+    try:
+        while length > 0 and (chunk := archive.read(min(ARCHIVE_CHUNK_SIZE, length))):
+            length -= len(chunk)
+            yield chunk
+    finally:
+        archive.close()
+
+
 ##########################################################################
 #
 # Endpoints for different resources types and scopes.
 #
+# NOTE: endpoints doing only blocking work (DB and filesystem) are plain defs,
+#  which FastAPI runs in its threadpool; async defs are kept for endpoints that
+#  stream their responses, and must hand every blocking call to a worker thread
+#  (anyio.to_thread) so the event loop is never stalled.
+#
 # TODO: review status codes.
 #
 # TODO: review error handling: consistent and descriptive error responses,
@@ -121,46 +776,89 @@ class NCDataGenerationResponse(BaseModel):
         200: {"description": "Calculations successfully scheduled for NC"},
     },
 )
-async def schedule_nc_raw_data_generation(
-    nc: str = Path(..., description=NC_FIELD_DESC)
+def schedule_nc_raw_data_generation(
+    background_tasks: BackgroundTasks,
+    nc: str = Path(..., description=NC_FIELD_DESC),
 ):
 
-    # Extract existing id_run values for the NC and convert to integers
-    existing_id_runs = [int(run["id_run"]) for run in AVAILABLE_RUNS.get(nc, [])]
-
-    # Find the next id_run
-    next_id_run = str(
-        max(existing_id_runs, default=0) + 1
-    )  # TODO: non-sequential integer ID_RUN numbers
-
     nc_dir = DATA_ROOT / nc
-    nc_id_run_dir = nc_dir / "c/md/lammps/100" / next_id_run
-    nc_sub_run_dir = nc_id_run_dir / "2000/0"
-
-    if not nc_dir.exists():
-        raise HTTPException(
-            status_code=404,
-            detail=f"Directory for nominal composition (ND) '{nc}' not found",
-        )
 
-    if not nc_id_run_dir.exists() or not nc_sub_run_dir.exists():
-        raise HTTPException(
-            status_code=404,
-            detail=f"Directory for ID_RUN '{next_id_run}' or for SUB_RUN '0' not found for NC '{nc}'",
+    while True:
+
+        # Find the next id_run
+        # NOTE: the directories of the next ID_RUN are checked before the write
+        #  transaction, so that the DB is not locked while /data is probed; the
+        #  transaction then only allocates that ID_RUN if the counter is unchanged,
+        #  and a concurrent request that took it in between means checking again
+        row = (
+            get_db()
+            .execute("SELECT next_id_run FROM next_id_runs WHERE nc = ?", (nc,))
+            .fetchone()
         )
 
-    # Schedule for SUB_RUN 0
-    AVAILABLE_RUNS.setdefault(nc, []).append(
-        {
-            "id_run": next_id_run,
-            "sub_runs": ["0"],
-            "run_scheduled_at": datetime.now(timezone.utc).isoformat(),
-        }
+        next_id_run = str(
+            row["next_id_run"] if row != None else 1
+        )  # TODO: non-sequential integer ID_RUN numbers
+
+        nc_id_run_dir = nc_dir / "c/md/lammps/100" / next_id_run
+
+        # NOTE: if the SUB_RUN 0 directory exists, so do all its parents; only
+        #  when it is missing is the NC directory checked, to tell which is missing
+        if not os.path.exists(nc_id_run_dir / "2000/0"):
+            if not os.path.exists(nc_dir):
+                raise HTTPException(
+                    status_code=404,
+                    detail=f"Directory for nominal composition (ND) '{nc}' not found",
+                )
+
+            raise HTTPException(
+                status_code=404,
+                detail=f"Directory for ID_RUN '{next_id_run}' or for SUB_RUN '0' not found for NC '{nc}'",
+            )
+
+        with db_transaction() as conn:
+
+            # NOTE: the per-NC counter is compared and bumped by a single statement
+            #  (an index lookup), which returns no row if it has moved on
+            if (
+                conn.execute(
+                    """
+                    INSERT INTO next_id_runs (nc, next_id_run) VALUES (?, ?)
+                    ON CONFLICT (nc) DO UPDATE SET next_id_run = excluded.next_id_run
+                    WHERE next_id_run = ?
+                    RETURNING next_id_run
+                    """,
+                    (nc, int(next_id_run) + 1, int(next_id_run)),
+                ).fetchone()
+                == None
+            ):
+                continue
+
+            # Schedule for SUB_RUN 0
+            now = datetime.now(timezone.utc)
+
+            conn.execute(
+                """
+                INSERT INTO runs (nc, id_run, run_scheduled_at, run_scheduled_epoch)
+                VALUES (?, ?, ?, ?)
+                """,
+                (nc, next_id_run, now.isoformat(), now.timestamp()),
+            )
+            conn.execute(
+                "INSERT INTO sub_runs (nc, id_run, sub_run) VALUES (?, ?, ?)",
+                (nc, next_id_run, "0"),
+            )
+
+        break
+
+    # NOTE: after the response is sent, warm the FS caches for the files that
+    #  the download of SUB_RUN 0 will package
+    background_tasks.add_task(warm_directory, nc_id_run_dir / "2000/0")
+    background_tasks.add_task(
+        warm_directory,
+        DATA_ROOT / f"{nc}-SOAPS" / "c/md/lammps/100" / next_id_run / "2000/0",
     )
 
-    # Persist to file
-    DB_AVAILABLE_RUNS_FILE.write_text(json.dumps(AVAILABLE_RUNS, indent=2))
-
     return {"nc": nc, "id_run": next_id_run, "status": STATUS_SCHEDULED}
 
 
@@ -201,16 +899,16 @@ class NCDataAugmentationResponse(BaseModel):
     },
 )
 def augment_nc_id_run(
+    background_tasks: BackgroundTasks,
     nc: str = Path(..., description=NC_FIELD_DESC),
     id_run: str = Path(..., description=ID_RUN_FIELD_DESC),
 ):  # TODO: allow user pass the set of SUB_RUNs to be added; instead of adding 1 to 14
 
-    # Check if the requested RUN_ID is available (TODO: replicated R1)
-    run_entry = next(
-        (run for run in AVAILABLE_RUNS.get(nc, []) if run["id_run"] == id_run), None
-    )
+    # NOTE: the checks run before the write transaction, so that the DB is not
+    #  locked while /data is probed (runs are never removed once scheduled)
 
-    if run_entry == None:
+    # Check if the requested RUN_ID is available (TODO: replicated R1)
+    if get_run_row(get_db(), nc, id_run) == None:
         raise HTTPException(
             status_code=404, detail=f"NC '{nc}' or ID_RUN '{id_run}' not available"
         )
@@ -218,23 +916,36 @@ def augment_nc_id_run(
     # Scheduling sub-runs from 1 to 14
     nc_sub_run_dir = DATA_ROOT / nc / "c/md/lammps/100" / id_run / "2000"
 
-    if not nc_sub_run_dir.exists():
+    if not os.path.exists(nc_sub_run_dir):
         raise HTTPException(
             status_code=404,
             detail=f"Directory for SUB_RUNs not found for NC '{nc}' and ID_RUN '{id_run}'",
         )
 
-    # NOTE: set() inherently removes duplicates
-    current_sub_runs = set(run_entry.get("sub_runs", []))
+    with db_transaction() as conn:
 
-    new_sub_runs = {str(i) for i in range(1, 15)}
+        now = datetime.now(timezone.utc)
 
-    # NOTE: .union() merges the two sets but keeps only unique values
-    run_entry["sub_runs"] = sorted(current_sub_runs.union(new_sub_runs), key=int)
-    run_entry["sub_runs_scheduled_at"] = datetime.now(timezone.utc).isoformat()
+        # NOTE: SUB_RUNs already scheduled are left as they are
+        conn.executemany(
+            "INSERT OR IGNORE INTO sub_runs (nc, id_run, sub_run) VALUES (?, ?, ?)",
+            [(nc, id_run, str(i)) for i in range(1, 15)],
+        )
+        conn.execute(
+            """
+            UPDATE runs
+            SET sub_runs_scheduled_at = ?, sub_runs_scheduled_epoch = ?
+            WHERE nc = ? AND id_run = ?
+            """,
+            (now.isoformat(), now.timestamp(), nc, id_run),
+        )
 
-    # Persist to file
-    DB_AVAILABLE_RUNS_FILE.write_text(json.dumps(AVAILABLE_RUNS, indent=2))
+    # NOTE: after the response is sent, warm the FS caches for the files that
+    #  the downloads of the SUB_RUNs will package
+    background_tasks.add_task(warm_directory, nc_sub_run_dir)
+    background_tasks.add_task(
+        warm_directory, DATA_ROOT / f"{nc}-SOAPS" / "c/md/lammps/100" / id_run / "2000"
+    )
 
     return {"nc": nc, "id_run": id_run, "status": STATUS_SCHEDULED}
 
@@ -259,65 +970,124 @@ def augment_nc_id_run(
         },
     },
 )
-def get_generated_nc_raw_data(
+async def get_generated_nc_raw_data(
+    request: Request,
+    background_tasks: BackgroundTasks,
     nc: str = Path(..., description=NC_FIELD_DESC),
     id_run: str = Path(..., description=ID_RUN_FIELD_DESC),
     sub_run: str = Path(..., description=SUB_RUN_FIELD_DESC),
 ):
 
-    # Check if the requested SUB_RUN is available (TODO: replicated R1)
-    run_entry = next(
-        (run for run in AVAILABLE_RUNS.get(nc, []) if run["id_run"] == id_run), None
+    # NOTE: the DB lookup and the directory listing and stats all block, so they
+    #  run on a worker thread and the event loop keeps serving other requests
+    files, files_stats = await anyio.to_thread.run_sync(
+        collect_sub_run_files, nc, id_run, sub_run
     )
 
-    if run_entry == None:
-        raise HTTPException(
-            status_code=404, detail=f"NC '{nc}' or ID_RUN '{id_run}' not available"
-        )
+    archive_name = f"{nc}_{id_run}_{sub_run}.zip"
 
-    sub_run_exists = sub_run in run_entry["sub_runs"] if run_entry else False
+    files_size = sum(st.st_size for st in files_stats[1:])
 
-    if not sub_run_exists:
-        raise HTTPException(
-            status_code=404,
-            detail=f"SUB_RUN '{sub_run}' is not available for NC '{nc}', ID_RUN '{id_run}'",
-        )
+    # NOTE: the key changes whenever a source file (or the sub-run directory
+    #  itself, on added/removed files) is modified
+    inputs_mtime_ns = max(st.st_mtime_ns for st in files_stats)
+    cache_key = hashlib.sha1(
+        f"{nc}|{id_run}|{sub_run}|{len(files)}|{inputs_mtime_ns}".encode()
+    ).hexdigest()
 
-    # Collecting files
-    target_dir = DATA_ROOT / nc / "c/md/lammps/100" / id_run / "2000" / sub_run
-    soaps_file = (
-        DATA_ROOT
-        / f"{nc}-SOAPS"
-        / "c/md/lammps/100"
-        / id_run
-        / "2000"
-        / sub_run
-        / "SOAPS.vec"
-    )
+    # Create ZIP archive
+    if files_size <= ARCHIVE_STREAM_MAX_SIZE:
 
-    if not target_dir.exists():
-        raise HTTPException(status_code=404, detail="Target sub-run not found")
+        # NOTE: the ETag is derived from the inputs, so a client resuming with
+        #  If-Range never gets the rest of an archive built from other files; it
+        #  differs from the tag of cached archives, whose layout is not the same
+        etag = f'"{cache_key}-stream"'
 
-    temp_dir = FilePath("/tmp") / f"{nc}_{id_run}_{sub_run}"
-    if temp_dir.exists():
-        shutil.rmtree(temp_dir)
-    temp_dir.mkdir(parents=True)
+        headers = {
+            "Content-Disposition": f'attachment; filename="{archive_name}"',
+            "Accept-Ranges": "bytes",
+            "ETag": etag,
+        }
 
-    # Copy the directory contents
-    for item in target_dir.iterdir():
-        shutil.copy(item, temp_dir)
+        if_range = request.headers.get("if-range")
+
+        # NOTE: small archives are never written to a named file under /tmp; their
+        #  bytes are sent to the client while the archive is being built (always
+        #  the whole archive when an If-Range no longer matches it)
+        if "range" not in request.headers or (if_range != None and if_range != etag):
+            return StreamingResponse(
+                stream_archive(files), media_type="application/zip", headers=headers
+            )
+
+        # NOTE: a Range request (resuming an interrupted download) needs the whole
+        #  archive first; it goes through the same unseekable ArchiveWriter so that
+        #  its bytes are identical to the streamed ones; it is kept in memory, as
+        #  the input size is bounded (a spooled file would roll over to disk for
+        #  inputs right at the threshold, due to the ZIP headers)
+        archive = io.BytesIO()
+        await anyio.to_thread.run_sync(
+            build_archive, ArchiveWriter(archive.write), files
+        )
+        archive_size = archive.tell()
+
+        try:
+            byte_range = parse_range_header(request.headers["range"], archive_size)
+        except ValueError:
+            archive.close()
+            return Response(
+                status_code=416,
+                headers={"Content-Range": f"bytes */{archive_size}"},
+            )
+
+        if byte_range == None:
+            archive.seek(0)
+            headers["Content-Length"] = str(archive_size)
+
+            return StreamingResponse(
+                iter_archive(archive, archive_size),
+                media_type="application/zip",
+                headers=headers,
+            )
+
+        start, end = byte_range
+        archive.seek(start)
+        headers["Content-Length"] = str(end - start + 1)
+        headers["Content-Range"] = f"bytes {start}-{end}/{archive_size}"
+
+        return StreamingResponse(
+            iter_archive(archive, end - start + 1),
+            status_code=status.HTTP_206_PARTIAL_CONTENT,
+            media_type="application/zip",
+            headers=headers,
+        )
 
-    # Copy SOAPs file
-    if soaps_file.exists():
-        shutil.copy(soaps_file, temp_dir)
+    archive_path, cache_hit = await anyio.to_thread.run_sync(
+        get_cached_archive, cache_key, files
+    )
 
-    # Create ZIP archive
-    archive_path = shutil.make_archive(str(temp_dir), "zip", root_dir=temp_dir)
+    # NOTE: a newly cached archive may push the cache over its size; evicting is
+    #  done after the response is sent, off the request path
+    if not cache_hit:
+        background_tasks.add_task(evict_archive_cache)
+
+    if ARCHIVE_ACCEL_REDIRECT_LOCATION:
+        return Response(
+            media_type="application/zip",
+            headers={
+                "X-Accel-Redirect": f"{ARCHIVE_ACCEL_REDIRECT_LOCATION.rstrip('/')}/{archive_path.name}",
+                "Content-Disposition": f'attachment; filename="{archive_name}"',
+            },
+        )
 
+    # NOTE: FileResponse emits the ASGI "http.response.pathsend" message when the
+    #  server supports it, letting the server sendfile(2) the archive from disk
+    #  to the socket instead of reading it into Python buffers; it also handles
+    #  Range and If-Range, against the ETag derived from the inputs
     return FileResponse(
         path=archive_path,
-        filename=FilePath(archive_path).name,
+        filename=archive_name,
         media_type="application/zip",
+        headers={"ETag": f'"{cache_key}"'},
     )
 
 
@@ -333,14 +1103,29 @@ def get_generated_nc_raw_data(
         """,
 )
 def get_available_raw_data():  # TODO: support for pagination/filtering
-    return AVAILABLE_RUNS
+    return Response(content=available_runs_json(), media_type="application/json")
 
 
 ##########################################################################
 
 
+class NCRunStatusResponse(BaseModel):
+    id_run: str = Field(
+        ..., description=ID_RUN_FIELD_DESC, example=ID_RUN_FIELD_EXAMPLE
+    )
+    sub_runs: list[str]
+    run_scheduled_at: str
+    sub_runs_scheduled_at: str | None = None
+    run_status: str = Field(..., example=STATUS_DONE)
+    sub_runs_status: str | None = Field(None, example=STATUS_RUNNING)
+
+
+# NOTE: the response model lets FastAPI serialize with pydantic-core directly;
+#  unset SUB_RUN fields are left out as before (no augmentation yet)
 @app.get(
     "/v1/generate/{nc}/{id_run}/status",
+    response_model=NCRunStatusResponse,
+    response_model_exclude_none=True,
     status_code=status.HTTP_200_OK,
     summary="Returns the statuses of a specific RUN",
     description="""
@@ -353,33 +1138,28 @@ def get_status_available_raw_data(
 ):
 
     # Check if the requested SUB_RUN is available (TODO: replicated R1)
-    run_entry = next(
-        (run for run in AVAILABLE_RUNS.get(nc, []) if run["id_run"] == id_run), None
-    )
+    row = get_run_row(get_db(), nc, id_run)
 
-    if run_entry == None:
+    if row == None:
         raise HTTPException(
             status_code=404, detail=f"NC '{nc}' or ID_RUN '{id_run}' not available"
         )
 
-    now = datetime.now(timezone.utc)
+    run_entry = run_entry_from_row(row)
 
-    elapsed = now - datetime.fromisoformat(
-        run_entry["run_scheduled_at"].replace("Z", "+00:00")
-    )
+    # NOTE: the epoch columns make each status a plain subtraction (no ISO parsing)
+    now = time.time()
 
-    run_entry["run_status"] = (
-        STATUS_DONE if elapsed.total_seconds() > JOB_RUN_TIME else STATUS_RUNNING
-    )
+    elapsed = now - row["run_scheduled_epoch"]
 
-    if "sub_runs_scheduled_at" in run_entry:
+    run_entry["run_status"] = STATUS_DONE if elapsed > JOB_RUN_TIME else STATUS_RUNNING
 
-        elapsed = now - datetime.fromisoformat(
-            run_entry["sub_runs_scheduled_at"].replace("Z", "+00:00")
-        )
+    if row["sub_runs_scheduled_epoch"] != None:
+
+        elapsed = now - row["sub_runs_scheduled_epoch"]
 
         run_entry["sub_runs_status"] = (
-            STATUS_DONE if elapsed.total_seconds() > JOB_RUN_TIME else STATUS_RUNNING
+            STATUS_DONE if elapsed > JOB_RUN_TIME else STATUS_RUNNING
         )
 
     return run_entry